@@ -51,6 +51,15 @@ class HDF5PathManager:
             dataset_name=dataset_name, quant_secs=quant_secs,
             num_midi_vals=num_midi_vals, extendsus=extendsus)
 
+    @staticmethod
+    def get_metadata_sidecar_path(hdf5_path):
+        """
+        Some HDF5 files store their per-entry metadata in a separate, columnar
+        parquet file (one row per entry), rather than as strings inside the
+        HDF5 file. This method returns the path of such sidecar file.
+        """
+        return hdf5_path + ".meta.parquet"
+
     @classmethod
     def parse_mel_hdf5_basename(cls, basename):
         """
@@ -30,27 +30,31 @@ class MONO_pudoms:
     AUDIO_EXT = ".wav"
     MIDI_EXT = ".midi"
 
-    def __init__(self, rootpath, splits=None):
+    def __init__(self, rootpath, splits=None, use_pyarrow=False):
         """
+        :param use_pyarrow: If true, the CSV is parsed with the (faster)
+          ``pyarrow`` engine, which must be installed.
         """
         self.rootpath = rootpath
         self.meta_path = os.path.join(rootpath, self.CSV_NAME)
         # filter sanity check
         if splits is None:
             splits = self.ALL_SPLITS
-        assert (s in self.ALL_SPLITS for s in splits), \
-            f"Unknown split in {splits}"
+        unknown_splits = set(splits) - self.ALL_SPLITS
+        assert not unknown_splits, f"Unknown split(s): {unknown_splits}"
         # load and filter csv
-        df = pd.read_csv(self.meta_path)
+        df = pd.read_csv(self.meta_path,
+                         engine="pyarrow" if use_pyarrow else "c")
         df = df[df["Split"].isin(splits)]
         # reformat into DATA_COLUMNS + metadata_str and gather
         columns = ["File_Number", "Split", "Duration",
                    "Composer", "Title"]
-        self.data = []
-        for i, (id, s, dur, comp, title) in df[columns].iterrows():
-            meta = (s, dur, comp, title)  
-            self.data.append((str(id), meta))
+        self.data = [(str(id), (s, dur, comp, title))
+                     for id, s, dur, comp, title
+                     in df[columns].itertuples(index=False, name=None)]
         self.full_data = df
+        # basename -> path, for fast lookups
+        self._by_basename = {os.path.basename(fn): fn for fn, _ in self.data}
 
     def get_file_abspath(self, basename):
         """
@@ -59,9 +63,11 @@ class MONO_pudoms:
          MIDI-Unprocessed_R1_D1-1-8_mid--AUDIO-from_mp3_08_R1_2015_wav--4'
         :returns: Unique absolute path for that basename
         """
-        matches = [fn for fn, _ in self.data if basename in fn]
-        assert len(matches) == 1, "Expected exactly 1 match!"
-        path = os.path.join(self.rootpath, matches[0])
+        try:
+            match = self._by_basename[basename]
+        except KeyError:
+            raise AssertionError("Expected exactly 1 match!")
+        path = os.path.join(self.rootpath, match)
         return path
 
 class PuDoMS:
@@ -77,27 +83,31 @@ class PuDoMS:
     AUDIO_EXT = ".wav"
     MIDI_EXTS = [".midi", ".mid"]
 
-    def __init__(self, rootpath, splits=None):
+    def __init__(self, rootpath, splits=None, use_pyarrow=False):
         """
+        :param use_pyarrow: If true, the CSV is parsed with the (faster)
+          ``pyarrow`` engine, which must be installed.
         """
         self.rootpath = rootpath
         self.meta_path = os.path.join(rootpath, self.CSV_NAME)
         # filter sanity check
         if splits is None:
             splits = self.ALL_SPLITS
-        assert (s in self.ALL_SPLITS for s in splits), \
-            f"Unknown split in {splits}"
+        unknown_splits = set(splits) - self.ALL_SPLITS
+        assert not unknown_splits, f"Unknown split(s): {unknown_splits}"
         # load and filter csv
-        df = pd.read_csv(self.meta_path)
+        df = pd.read_csv(self.meta_path,
+                         engine="pyarrow" if use_pyarrow else "c")
         df = df[df["Split"].isin(splits)]
         # reformat into DATA_COLUMNS + metadata_str and gather
         columns = ["File_Number", "Split", "Duration",
                    "Composer", "Title"]
-        self.data = []
-        for i, (id, s, dur, comp, title) in df[columns].iterrows():
-            meta = (s, dur, comp, title)  
-            self.data.append((str(id), meta))
+        self.data = [(str(id), (s, dur, comp, title))
+                     for id, s, dur, comp, title
+                     in df[columns].itertuples(index=False, name=None)]
         self.full_data = df
+        # basename -> path, for fast lookups
+        self._by_basename = {os.path.basename(fn): fn for fn, _ in self.data}
 
     def get_file_abspath(self, basename):
         """
@@ -106,10 +116,10 @@ class PuDoMS:
          MIDI-Unprocessed_R1_D1-1-8_mid--AUDIO-from_mp3_08_R1_2015_wav--4'
         :returns: Unique absolute path for that basename
         """
-        for ext in self.MIDI_EXTS:
+        match = self._by_basename.get(basename)
+        if match is not None:
             # Attempt to find a matching file with each supported extension
-            matches = [fn for fn, _ in self.data if basename in fn]
-            for match in matches:
+            for ext in self.MIDI_EXTS:
                 midi_path = os.path.join(self.rootpath, match + ext)
                 if os.path.exists(midi_path):
                     return midi_path
@@ -23,8 +23,10 @@ from ast import literal_eval
 #
 import torch
 import numpy as np
+import pandas as pd
 import h5py
 #
+from .. import HDF5PathManager
 from ..utils import IncrementalHDF5
 from .midi import MidiToPianoRoll
 
@@ -319,6 +321,9 @@ class MelMaps(torch.utils.data.Dataset):
     Assuming we computed the log-mels of the MAPS dataset and the MIDIs as
     pianorolls into 2 synchronized IncrementalHDF5 files, this dataset
     retrieves the log-mel and piano roll features of a given set of files.
+
+    :cvar ROLL_DTYPE: Piano rolls may be stored with a compact dtype (e.g.
+      ``uint8``), but they are always retrieved with this dtype.
     """
 
     NUM_MIDI_VALUES = MidiToPianoRoll.NUM_MIDI_VALUES
@@ -328,6 +333,7 @@ class MelMaps(torch.utils.data.Dataset):
     SUS_IDX = -3
     SOFT_IDX = -2
     TEN_IDX = -1
+    ROLL_DTYPE = np.float32
 
     @classmethod
     def _init_helper(cls, hdf5_logmels_path, hdf5_pianorolls_path,
@@ -359,15 +365,36 @@ class MelMaps(torch.utils.data.Dataset):
         metadata = []
         def preprocess_metadata_string(s):
           return s.replace("nan", "None")
-        metadata = []
-        for t in h5m[IncrementalHDF5.METADATA_NAME]:
-            try:
-                preprocessed_metadata = preprocess_metadata_string(t.decode("utf-8"))
-                parsed_metadata = literal_eval(preprocessed_metadata)
-                metadata.append(parsed_metadata)
-            except ValueError as e:
-                print(f"Error parsing metadata: {t.decode('utf-8')}. Exception: {e}")
-                continue
+        # metadata may be stored in columnar sidecars, one row per entry.
+        # In that case the HDF5 metadata strings are empty, so the sidecars
+        # are the ones checked for consistency
+        sidecars = [pd.read_parquet(p) for p in (
+            HDF5PathManager.get_metadata_sidecar_path(hdf5_logmels_path),
+            HDF5PathManager.get_metadata_sidecar_path(hdf5_pianorolls_path))
+                    if os.path.isfile(p)]
+        if len(sidecars) == 2:
+            assert sidecars[0].equals(sidecars[1]), \
+                "Unequal metadata sidecars between logmel and piano roll?"
+        for sc in sidecars:
+            assert len(sc) == h5m[IncrementalHDF5.IDXS_NAME].shape[1], \
+                "Metadata sidecar doesn't match the number of HDF5 entries!"
+        if sidecars:
+            metadata = [tuple(None if pd.isna(x) else x for x in row)
+                        for row in sidecars[0].itertuples(
+                                index=False, name=None)]
+        elif (h5m[IncrementalHDF5.METADATA_NAME][:] == b"").any():
+            raise FileNotFoundError(
+                "HDF5 metadata is empty and no sidecar was found. Was the "
+                f"HDF5 creation interrupted? {hdf5_logmels_path}")
+        else:
+            for t in h5m[IncrementalHDF5.METADATA_NAME]:
+                try:
+                    preprocessed_metadata = preprocess_metadata_string(t.decode("utf-8"))
+                    parsed_metadata = literal_eval(preprocessed_metadata)
+                    metadata.append(parsed_metadata)
+                except ValueError as e:
+                    print(f"Error parsing metadata: {t.decode('utf-8')}. Exception: {e}")
+                    continue
         # metadata = [literal_eval(t.decode("utf-8"))
         #             for t in h5m[IncrementalHDF5.METADATA_NAME]]
         chosen_metadata, chosen_file_idxs = zip(
@@ -432,7 +459,8 @@ class MelMaps(torch.utils.data.Dataset):
         """
         beg, end, meta = self.data[idx]
         logmel = self.h5m[IncrementalHDF5.DATA_NAME][:, beg:end]
-        roll = self.h5r[IncrementalHDF5.DATA_NAME][:, beg:end]
+        roll = self.h5r[IncrementalHDF5.DATA_NAME][:, beg:end].astype(
+            self.ROLL_DTYPE, copy=False)
         #
         if self.as_tensors:
             logmel = torch.from_numpy(logmel)
@@ -519,7 +547,7 @@ class MelMapsChunks(MelMaps):
         self.mel_buffer = np.zeros((self.mels.shape[0], chunk_length),
                                    dtype=self.mels.dtype)
         self.roll_buffer = np.zeros((self.rolls.shape[0], chunk_length),
-                                    dtype=self.rolls.dtype)
+                                    dtype=self.ROLL_DTYPE)
 
     def __getitem__(self, idx):
         """
@@ -553,7 +581,8 @@ class MelMapsChunks(MelMaps):
                            else self.logmel_oob_pad_val)
             self.mel_buffer[:, -pad:] = mel_pad_val
         else:  # no pad
-            self.roll_buffer = self.rolls[:, beg:end]
+            self.roll_buffer = self.rolls[:, beg:end].astype(
+                self.ROLL_DTYPE, copy=False)
             self.mel_buffer = self.mels[:, beg:end]
         # return buffer copy (optionally convert to tensor)
         if self.as_tensors:
@@ -15,6 +15,14 @@ from collections import defaultdict, OrderedDict
 import mido
 import numpy as np
 import pandas as pd
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        """
+        Fallback if ``numba`` is not installed: functions stay pure Python.
+        """
+        return lambda fn: fn
 #
 from .key_model import KeyboardStateMachine
 
@@ -38,13 +46,25 @@ class SingletrackMidiParser:
     CONTROL_CODES = {64: "sustain_pedal", 66: "sostenuto_pedal",
                      67: "soft_pedal", 121: "reset_all_controllers"}
 
+    @staticmethod
+    def open_midi(midi_path):
+        """
+        :param midi_path: Path to a MIDI file, or a binary file-like object
+          (e.g. ``io.BytesIO``) with the MIDI contents.
+        :returns: ``mido.MidiFile`` instance with the loaded file.
+        """
+        if hasattr(midi_path, "read"):
+            return mido.MidiFile(file=midi_path)
+        return mido.MidiFile(midi_path)
+
     @classmethod
     def load_midi(cls, midi_path):
         """
         :param str midi_path: Path to a MIDI file, assumed single-track.
+          It can also be a file-like object, see ``open_midi``.
         :returns: ``mido.MidiFile`` instance with the loaded file.
         """
-        mid = mido.MidiFile(midi_path)
+        mid = cls.open_midi(midi_path)
         assert mid.type == cls.SINGLETRACK_MIDI_CODE, \
             "Only single-track MIDI files expected!"
         return mid
@@ -268,7 +288,7 @@ class GeneralMidiParser(SingletrackMidiParser):
 
     @classmethod
     def load_midi(cls, midi_path):
-        mid = mido.MidiFile(midi_path)
+        mid = cls.open_midi(midi_path)
         try:
             cls.merge_tracks_to_singletrack(mid)
         except Exception as e:
@@ -350,7 +370,7 @@ class MaestroMidiParser(SingletrackMidiParser):
         Like parent method, but we call ``convert_maestro_midi_to_singletrack``
         before proceeding further.
         """
-        mid = mido.MidiFile(midi_path)
+        mid = cls.open_midi(midi_path)
         cls.convert_maestro_midi_to_singletrack(mid)  # in-place conversion!
         assert mid.type == cls.SINGLETRACK_MIDI_CODE, \
             "Only single-track MIDI files expected!"
@@ -360,6 +380,51 @@ class MaestroMidiParser(SingletrackMidiParser):
 # ##############################################################################
 # # PIANO ROLL CONVERTER
 # ##############################################################################
+@njit(cache=True)
+def _write_pedal_roll(roll, idxs, vals):
+    """
+    Writes a quantized pedal sequence onto the given 1D roll, in-place.
+
+    :param idxs: Int array with the (non-empty, sorted) frame index of each
+      pedal event.
+    :param vals: Int array with the pedal value of each event. Each value
+      is held until the next event, and the last one until the roll end.
+    """
+    for i in range(len(idxs) - 1):
+        roll[idxs[i]:idxs[i + 1]] = vals[i]
+    roll[idxs[-1]:] = vals[-1]
+
+
+@njit(cache=True)
+def _write_key_events(onset_roll, offset_roll, frame_roll,
+                      beg_idxs, end_idxs, keys, vels):
+    """
+    Writes the quantized key events onto the given ``(keys, frames)`` rolls,
+    in-place. Onsets in the same frame as the previous onset of the same key
+    are skipped.
+
+    :param beg_idxs: Int array with the onset frame of each event.
+    :param end_idxs: Int array with the offset frame of each event.
+    :param keys: Int array with the MIDI key of each event.
+    :param vels: Int array with the velocity of each event.
+    """
+    # Track the last onset frame for each key
+    last_onset_frame = np.full(onset_roll.shape[0], -1, dtype=np.int64)
+    for i in range(len(beg_idxs)):
+        beg, end, key, vel = beg_idxs[i], end_idxs[i], keys[i], vels[i]
+        # Skip if this onset is in the same frame as the last onset for this key
+        if beg == last_onset_frame[key]:
+            print("Skipping simultaneous onset for key", key,
+                  "at frame", beg)
+            continue
+        # Update last onset frame for this key
+        last_onset_frame[key] = beg
+        # Write the onset and offset to the roll
+        onset_roll[key, beg] = vel
+        offset_roll[key, end] = vel
+        frame_roll[key, beg:end] = vel
+
+
 class MidiToPianoRoll:
     """
     This class makes use of the MIDI parsers to fully convert from a MIDI path
@@ -440,50 +505,23 @@ class MidiToPianoRoll:
         soft_roll = np.zeros_like(sus_roll)
 
         # write pedal sequences onto quantized rolls
-        if not sus_states.empty:
-            sus_idxs = np.searchsorted(
-                frame_ts, sus_states["ts"], side="right") - 1
-            for beg, end, v in zip(sus_idxs[:-1], sus_idxs[1:],
-                                   sus_states["val"][:-1]):
-                sus_roll[beg:end] = v
-            sus_roll[sus_idxs[-1]:] = sus_states["val"].iloc[-1]
-        #
-        if not ten_states.empty:
-            ten_idxs = np.searchsorted(
-                frame_ts, ten_states["ts"], side="right") - 1
-            for beg, end, v in zip(ten_idxs[:-1], ten_idxs[1:],
-                                   ten_states["val"][:-1]):
-                ten_roll[beg:end] = v
-            ten_roll[ten_idxs[-1]:] = ten_states["val"].iloc[-1]
-        #
-        if not soft_states.empty:
-            soft_idxs = np.searchsorted(
-                frame_ts, soft_states["ts"], side="right") - 1
-            for beg, end, v in zip(soft_idxs[:-1], soft_idxs[1:],
-                                   soft_states["val"][:-1]):
-                soft_roll[beg:end] = v
-            soft_roll[soft_idxs[-1]:] = soft_states["val"].iloc[-1]
+        for states, roll in ((sus_states, sus_roll), (ten_states, ten_roll),
+                             (soft_states, soft_roll)):
+            if not states.empty:
+                idxs = np.searchsorted(
+                    frame_ts, states["ts"], side="right") - 1
+                _write_pedal_roll(roll, idxs,
+                                  states["val"].to_numpy(dtype=np.int64))
 
         # write key events onto quantized rolls
         beg_idxs = np.searchsorted(
             frame_ts, key_events["onset"], side="right") - 1
         end_idxs = np.searchsorted(
             frame_ts, key_events["offset"], side="right") - 1
-        last_onset_frame = [-1] * cls.NUM_MIDI_VALUES  # Track the last onset frame for each key
-
-        for beg, end, key, vel in zip(beg_idxs, end_idxs, key_events["key"], key_events["vel"]):
-            # Skip if this onset is in the same frame as the last onset for this key
-            if beg == last_onset_frame[key]:
-                print(f"Skipping simultaneous onset for key {key} at frame {beg}")
-                continue
-        
-            # Update last onset frame for this key
-            last_onset_frame[key] = beg
-        
-            # Write the onset and offset to the roll
-            onset_roll[key, beg] = vel
-            offset_roll[key, end] = vel
-            frame_roll[key, beg:end] = vel
+        _write_key_events(onset_roll, offset_roll, frame_roll,
+                          beg_idxs, end_idxs,
+                          key_events["key"].to_numpy(dtype=np.int64),
+                          key_events["vel"].to_numpy(dtype=np.int64))
         # import matplotlib.pyplot as plt
         # plt.clf(); plt.plot(sus_roll); plt.show()
         # plt.clf(); plt.plot(soft_roll); plt.show()
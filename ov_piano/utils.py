@@ -10,13 +10,26 @@ various modules and applications.
 
 import os
 import json
+import math
 import random
+from collections.abc import Mapping
+from functools import lru_cache
 #
 import torch
 import torchaudio
-from torchaudio.transforms import MelSpectrogram, AmplitudeToDB
+from torchaudio.transforms import MelSpectrogram
 import numpy as np
 import h5py
+try:
+    # optional, registers additional HDF5 compression filters (e.g. Blosc2)
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+try:
+    # optional, faster decoding of PCM wav files via libsndfile
+    import soundfile
+except ImportError:
+    soundfile = None
 #
 from .logging import make_timestamp
 
@@ -24,6 +37,27 @@ from .logging import make_timestamp
 # ##############################################################################
 # # HDF5 DATABASES
 # ##############################################################################
+def get_hdf5_compression(name):
+    """
+    :param name: One of ``lzf``, ``gzip`` (both built into h5py) or
+      ``blosc2_zstd``, which requires ``hdf5plugin``. The latter provides
+      higher compression at comparable speed, particularly for sparse data
+      like piano rolls, but the ``hdf5plugin`` package is then also needed to
+      read the files.
+    :returns: The corresponding ``compression`` argument for
+      ``IncrementalHDF5``.
+    """
+    if name in ("lzf", "gzip"):
+        return name
+    elif name == "blosc2_zstd":
+        if hdf5plugin is None:
+            raise ImportError("blosc2_zstd compression requires hdf5plugin!")
+        return hdf5plugin.Blosc2(cname="zstd", clevel=3,
+                                 filters=hdf5plugin.Blosc2.BITSHUFFLE)
+    else:
+        raise ValueError(f"Unknown HDF5 compression: {name}")
+
+
 class IncrementalHDF5:
     """
     Incrementally concatenate matrices of same height. This can be useful to
@@ -36,18 +70,24 @@ class IncrementalHDF5:
 
     def __init__(self, out_path, height, dtype=np.float32, compression="lzf",
                  data_chunk_length=500, metadata_chunk_length=500,
-                 err_if_exists=True):
+                 err_if_exists=True, cache_bytes=None):
         """
         :param height: This class incrementally stores a matrix of shape
           ``(height, w++)``, where ``height`` is always fixed.
         :param compression: ``lzf`` is fast, ``gzip`` slower but provides
-          better compression
+          better compression. It can also be a mapping with the h5py
+          ``compression`` and ``compression_opts`` (e.g. a filter from
+          ``hdf5plugin``, see ``get_hdf5_compression``). Plugin filters
+          may not support variable-length strings, so in that case the
+          metadata is compressed with ``lzf``.
         :param data_chunk_length: Every I/O operation goes by chunks. A too
           small chunk size will cause many syscalls (slow), and with a too
           large chunk size we will be loading too much information in a single
           syscall (also slow, and bloats the RAM). Ideally, the chunk length is
           a bit larger than what is usually needed (e.g. if we expect to read
           between 10 and 50 rows at a time, we can choose chunk=60).
+        :param cache_bytes: Size of the HDF5 raw chunk cache for the file. If
+          not given, the h5py default (1MB) is used.
         """
         self.out_path = out_path
         self.height = height
@@ -58,20 +98,28 @@ class IncrementalHDF5:
             if os.path.isfile(out_path):
                 raise FileExistsError(f"File already exists! {out_path}")
         #
-        self.h5f = h5py.File(out_path, "w")
+        if isinstance(compression, Mapping):
+            compression_kwargs = dict(compression)
+            str_compression_kwargs = {"compression": "lzf"}
+        else:
+            compression_kwargs = {"compression": compression}
+            str_compression_kwargs = compression_kwargs
+        self.h5f = h5py.File(out_path, "w", rdcc_nbytes=cache_bytes)
         self.data_ds = self.h5f.create_dataset(
             self.DATA_NAME, shape=(height, 0), maxshape=(height, None),
-            dtype=dtype, compression=compression,
-            chunks=(height, data_chunk_length))
+            dtype=dtype, chunks=(height, data_chunk_length),
+            **compression_kwargs)
         self.metadata_ds = self.h5f.create_dataset(
             self.METADATA_NAME, shape=(0,), maxshape=(None,),
-            compression=compression, dtype=h5py.string_dtype(),
-            chunks=(metadata_chunk_length,))
+            dtype=h5py.string_dtype(), chunks=(metadata_chunk_length,),
+            **str_compression_kwargs)
         self.data_idxs_ds = self.h5f.create_dataset(
             self.IDXS_NAME, shape=(2, 0), maxshape=(2, None), dtype=np.int64,
-            compression=compression, chunks=(2, metadata_chunk_length))
+            chunks=(2, metadata_chunk_length), **compression_kwargs)
         self._current_data_width = 0
         self._num_entries = 0
+        self._data_capacity = 0
+        self._entries_capacity = 0
 
     def __enter__(self):
         """
@@ -85,31 +133,81 @@ class IncrementalHDF5:
 
     def close(self):
         """
+        Trims any unused reserved space (see ``reserve``) and closes the file.
         """
+        if self._data_capacity > self._current_data_width:
+            self.data_ds.resize((self.height, self._current_data_width))
+        if self._entries_capacity > self._num_entries:
+            self.metadata_ds.resize((self._num_entries,))
+            self.data_idxs_ds.resize((2, self._num_entries))
         self.h5f.close()
 
-    def append(self, matrix, metadata_str):
+    def reserve(self, data_width, num_entries=0):
         """
-        :param matrix: dtype array of shape ``(fix_height, width)``
+        Resizes the HDF5 datasets in advance to hold at least the given total
+        data width and number of entries, so that subsequent appends within
+        these bounds write into the existing space without resizing. Unused
+        space is trimmed on ``close``, so overestimations are harmless.
+
+        :param data_width: Expected total width of all appended matrices.
+        :param num_entries: Expected total number of appended matrices.
+        """
+        if data_width > self._data_capacity:
+            self.data_ds.resize((self.height, data_width))
+            self._data_capacity = data_width
+        if num_entries > self._entries_capacity:
+            self.metadata_ds.resize((num_entries,))
+            self.data_idxs_ds.resize((2, num_entries))
+            self._entries_capacity = num_entries
+
+    def _write_block(self, data, metadata_strs, widths):
+        """
+        Appends one or more consecutive entries with a single write (and a
+        resize, if the reserved space is exceeded) per HDF5 dataset.
+
+        :param data: dtype array of shape ``(fix_height, sum(widths))``,
+          containing the horizontal concatenation of all entries.
+        :param metadata_strs: One metadata string per entry.
+        :param widths: Width of each entry, in the same order as
+          ``metadata_strs``.
         """
         n = self._num_entries
-        h, w = matrix.shape
-        assert h == self.height, \
-            f"Shape was {(h, w)} but should be ({self.height}, ...). "
-        # update arr size and add data
-        new_data_w = self._current_data_width + w
-        self.data_ds.resize((self.height, new_data_w))
-        self.data_ds[:, self._current_data_width:new_data_w] = matrix
-        # # update meta-arr size and add metadata
-        self.metadata_ds.resize((n + 1,))
-        self.metadata_ds[n] = metadata_str
-        # update data-idx size and add entry
-        self.data_idxs_ds.resize((2, n + 1))
-        self.data_idxs_ds[:, n] = (self._current_data_width, new_data_w)
+        k = len(widths)
+        ends = self._current_data_width + np.cumsum(widths, dtype=np.int64)
+        begs = ends - widths
+        new_data_w = int(ends[-1])
+        # update arr size if needed and add data
+        if new_data_w > self._data_capacity:
+            self.data_ds.resize((self.height, new_data_w))
+            self._data_capacity = new_data_w
+        self.data_ds[:, self._current_data_width:new_data_w] = data
+        # update meta-arr and data-idx sizes if needed
+        if (n + k) > self._entries_capacity:
+            self.metadata_ds.resize((n + k,))
+            self.data_idxs_ds.resize((2, n + k))
+            self._entries_capacity = n + k
+        # add metadata and data-idx entries
+        self.metadata_ds[n:n + k] = np.array(
+            metadata_strs, dtype=h5py.string_dtype())
+        self.data_idxs_ds[:, n:n + k] = np.stack([begs, ends])
         #
         self.h5f.flush()
         self._current_data_width = new_data_w
-        self._num_entries += 1
+        self._num_entries += k
+
+    def append(self, matrix, metadata_str, pad_to=None):
+        """
+        :param matrix: dtype array of shape ``(fix_height, width)``
+        :param pad_to: If given and larger than ``width``, the matrix is
+          stored zero-padded at the end to have this width.
+        """
+        h, w = matrix.shape
+        assert h == self.height, \
+            f"Shape was {(h, w)} but should be ({self.height}, ...). "
+        if (pad_to is not None) and (pad_to > w):
+            matrix = np.pad(matrix, ((0, 0), (0, pad_to - w)))
+            w = pad_to
+        self._write_block(matrix, [metadata_str], [w])
 
     @classmethod
     def get_element(cls, h5file, elt_idx):
@@ -134,21 +232,130 @@ class IncrementalHDF5:
         return num_elements
 
 
+class BufferedIncrementalHDF5(IncrementalHDF5):
+    """
+    Like its parent class, but appended matrices are first copied into a RAM
+    buffer, which is written to disk in bulk whenever it gets full (and when
+    closing). Many small HDF5 writes are much slower than a few large ones,
+    since each one incurs in resizing and chunk/metadata updates.
+
+    Note that entries appended but not yet flushed are not in the file.
+    """
+
+    def __init__(self, out_path, height, dtype=np.float32, compression="lzf",
+                 data_chunk_length=500, metadata_chunk_length=500,
+                 err_if_exists=True, cache_bytes=None, buffer_length=None):
+        """
+        :param buffer_length: Width of the RAM buffer. If not given, it will
+          be ``16 * data_chunk_length``. Matrices wider than this are
+          written directly.
+
+        See parent class for the rest of parameters.
+        """
+        super().__init__(out_path, height, dtype, compression,
+                         data_chunk_length, metadata_chunk_length,
+                         err_if_exists, cache_bytes)
+        if buffer_length is None:
+            buffer_length = 16 * data_chunk_length
+        self._buffer = np.empty((height, buffer_length), dtype=dtype)
+        self._buffer_w = 0
+        self._buffer_metadata = []
+        self._buffer_widths = []
+
+    def close(self):
+        """
+        """
+        self.flush()
+        super().close()
+
+    def flush(self):
+        """
+        Writes all buffered entries to the HDF5 file, and empties the buffer.
+        """
+        if self._buffer_widths:
+            self._write_block(self._buffer[:, :self._buffer_w],
+                              self._buffer_metadata, self._buffer_widths)
+        self._buffer_w = 0
+        self._buffer_metadata = []
+        self._buffer_widths = []
+
+    def append(self, matrix, metadata_str, pad_to=None):
+        """
+        :param matrix: dtype array of shape ``(fix_height, width)``. It is
+          copied, so it can be safely modified after this call.
+        :param pad_to: If given and larger than ``width``, the matrix is
+          stored zero-padded at the end to have this width. The padding is
+          written directly into the buffer, without extra allocations.
+        """
+        h, w_in = matrix.shape
+        assert h == self.height, \
+            f"Shape was {(h, w_in)} but should be ({self.height}, ...). "
+        w = w_in if pad_to is None else max(w_in, pad_to)
+        buffer_length = self._buffer.shape[1]
+        if (self._buffer_w + w) > buffer_length:
+            self.flush()
+        if w > buffer_length:
+            # doesn't fit into the buffer, write directly
+            super().append(matrix, metadata_str, pad_to)
+        else:
+            beg = self._buffer_w
+            self._buffer[:, beg:(beg + w_in)] = matrix
+            self._buffer[:, (beg + w_in):(beg + w)] = 0
+            self._buffer_w += w
+            self._buffer_metadata.append(metadata_str)
+            self._buffer_widths.append(w)
+
+
 # ##############################################################################
 # # AUDIO PREPROCESSING
 # ##############################################################################
+@lru_cache(maxsize=None)
+def get_resampler(sr_in, target_sr, device="cpu"):
+    """
+    :returns: A ``torchaudio.transforms.Resample`` module from ``sr_in`` to
+      ``target_sr``, on the given device. Modules are cached, so the
+      resampling kernel is only computed once per combination.
+    """
+    return torchaudio.transforms.Resample(sr_in, target_sr).to(device)
+
+
+def get_resampled_length(path, target_sr=16000):
+    """
+    :param path: Absolute path to an audio file.
+    :returns: The number of samples that ``torch_load_resample_audio`` would
+      return for this file, computed from the file header only (i.e. without
+      decoding the audio).
+    """
+    if soundfile is not None:
+        info = soundfile.info(path)
+        num_frames, sr_in = info.frames, info.samplerate
+    else:
+        info = torchaudio.info(path)
+        num_frames, sr_in = info.num_frames, info.sample_rate
+    if sr_in == target_sr:
+        return num_frames
+    return math.ceil(num_frames * target_sr / sr_in)
+
+
 def torch_load_resample_audio(path, target_sr=16000, mono=True,
                               normalize_wav=True, device="cpu"):
     """
     Analogously to ``librosa.load``, this function loads and resamples a wav
     file. The resampling operation from torchaudio is much faster.
-    :param path: Absolute path to the wav file to be loaded
+    If ``soundfile`` is installed and ``normalize_wav`` is true, it is used
+    to decode the file, otherwise ``torchaudio``.
+    :param path: Absolute path to the wav file to be loaded, or a binary
+      file-like object (e.g. ``io.BytesIO``) with its contents.
     :param target_sr: Returned wavfile will have this sample rate
     :param mono: If true, returned wavfile will be averaged down to mono.
     :param device: Returned wavfile will be on the specified device.
     """
-    wave, sr_in = torchaudio.load(path, normalize=normalize_wav)
-    resampler = torchaudio.transforms.Resample(sr_in, target_sr).to(device)
+    if normalize_wav and (soundfile is not None):
+        arr, sr_in = soundfile.read(path, dtype="float32", always_2d=True)
+        wave = torch.from_numpy(arr.T)  # (chans, time), like torchaudio
+    else:
+        wave, sr_in = torchaudio.load(path, normalize=normalize_wav)
+    resampler = get_resampler(sr_in, target_sr, str(device))
     if mono:
         wave = wave.mean(dim=0)
     wave = resampler(wave.to(device))
@@ -161,9 +368,16 @@ class TorchWavToLogmel(torch.nn.Module):
     to log-mel spectrograms. Much faster, results differ only slightly.
     Since this is a torch Module, can be sent ``.to("cuda")`` in order
     to admit CUDA tensors.
+
+    :cvar TOP_DB: Log-mels are clipped to this many dB below their maximum.
+    :cvar AMIN: Powers are clipped to this minimum before the log.
     """
+    TOP_DB = 80.0
+    AMIN = 1e-10
+
     def __init__(self, samplerate, winsize, hopsize, n_mels,
-                 mel_fmin=50, mel_fmax=8_000, window_fn=torch.hann_window):
+                 mel_fmin=50, mel_fmax=8_000, window_fn=torch.hann_window,
+                 cache_path=None):
         """
         :param samplerate: Expected audio input samplerate.
         :param winsize: Window size for the STFT (and mel).
@@ -172,25 +386,77 @@ class TorchWavToLogmel(torch.nn.Module):
         :param n_mels: Number of mel bins.
         :param mel_fmin: Lowest mel bin, in Hz.
         :param mel_fmax: Highest mel bin, in Hz.
+        :param cache_path: Optional path to a ``.pt`` file with the STFT
+          window and mel filterbank. If it exists, they are loaded from it,
+          otherwise they are saved into it. This ensures that the exact
+          same constants are used across runs. The path should be unique
+          for the given parameters.
         """
         super().__init__()
         self.melspec = MelSpectrogram(
             samplerate, winsize, hop_length=hopsize,
             f_min=mel_fmin, f_max=mel_fmax, n_mels=n_mels,
             power=2, window_fn=window_fn)
-        self.to_db = AmplitudeToDB(stype="power", top_db=80.0)
+        if cache_path is not None:
+            if os.path.isfile(cache_path):
+                self.load_state_dict(torch.load(cache_path))
+            else:
+                torch.save(self.state_dict(), cache_path)
         # run melspec once, otherwise produces NaNs!
         self.melspec(torch.rand(winsize * 10))
 
+    def to_db_(self, mel):
+        """
+        In-place conversion of the given power mel spectrogram to dB, clipped
+        to ``TOP_DB`` below its maximum. Equivalent to torchaudio's
+        ``AmplitudeToDB(stype="power", top_db=TOP_DB)``, but without
+        allocating intermediate tensors.
+        :returns: The modified ``mel``.
+        """
+        mel.clamp_min_(self.AMIN).log10_().mul_(10.0)
+        torch.maximum(mel, mel.max() - self.TOP_DB, out=mel)
+        return mel
+
     def __call__(self, wav_arr):
         """
         :param wav_arr: Float tensor array of either 1D or ``(chans, time)``
         :returns: log-mel spectrogram of shape ``(n_mels, t)``
         """
         mel = self.melspec(wav_arr)
-        log_mel = self.to_db(mel)
+        log_mel = self.to_db_(mel)
         return log_mel
 
+    def forward_batch(self, wav_arrs):
+        """
+        Batched version of ``__call__``: the given 1D waveforms are converted
+        via a single batched STFT and mel projection, and each log-mel is
+        cropped back to its own length. The dB conversion is done separately
+        for each waveform, so the ``top_db`` clipping is unaffected by the
+        batch.
+
+        To get the same result as ``__call__``, each waveform is first
+        reflect-padded at the end by half a window (as the centered STFT
+        would do), and only then zero-padded to the common length. This way,
+        none of the returned frames sees the zero-padding.
+
+        :param wav_arrs: Collection of 1D float tensors, all on the same
+          device and with possibly different lengths.
+        :returns: List with one log-mel spectrogram of shape ``(n_mels, t_i)``
+          per given waveform.
+        """
+        lengths = [len(w) for w in wav_arrs]
+        half_win = self.melspec.n_fft // 2
+        batch = torch.nn.utils.rnn.pad_sequence(
+            [torch.nn.functional.pad(w[None, None], (0, half_win),
+                                     mode="reflect")[0, 0]
+             for w in wav_arrs], batch_first=True)
+        mels = self.melspec(batch)
+        hopsize = self.melspec.hop_length
+        # with centered STFT, a wave of length L yields 1 + L//hop frames
+        log_mels = [self.to_db_(mel[:, :(1 + l // hopsize)])
+                    for mel, l in zip(mels, lengths)]
+        return log_mels
+
 
 # ##############################################################################
 # # DL MODEL SERIALIZATION
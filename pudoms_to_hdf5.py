@@ -9,23 +9,36 @@ stores them into 2 separate HDF5 files as consecutive matrices to be
 efficiently queried for DL training and evaluation.
 
 The roll file is a vertical stack of [onsets; frames; pedals] having a
-dimensionality equal to 3+2*num_midi_notes.
-It also stores the metadata and relevant parameters in the filenames, so data
-can be fully traced to its origins.
+dimensionality equal to 3+2*num_midi_notes. Optionally, onsets, frames and
+pedals can be stored into 3 separate files instead.
+It also stores the relevant parameters in the filenames, and the per-file
+metadata in a parquet sidecar next to each HDF5 file, so data can be fully
+traced to its origins. Note that the sidecars are only written once all files
+have been processed: HDF5 files from an interrupted run have no usable
+metadata, and must be recomputed.
 """
 
 
 import os
+import gc
+import queue
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 # For omegaconf
 from dataclasses import dataclass
+from typing import Optional
 #
 from omegaconf import OmegaConf
 import torch
 import numpy as np
+import pandas as pd
 # import matplotlib.pyplot as plt
 #
 from ov_piano import HDF5PathManager
-from ov_piano.utils import IncrementalHDF5
+from ov_piano.utils import BufferedIncrementalHDF5, get_hdf5_compression
+from ov_piano.utils import get_resampled_length
 from ov_piano.utils import TorchWavToLogmel, torch_load_resample_audio
 from ov_piano.data.PuDoMS import PuDoMS
 from ov_piano.data.midi import GeneralMidiParser, MidiToPianoRoll
@@ -51,13 +64,50 @@ class ConfDef:
 
     :cvar bool MIDI_SUS_EXTEND: If true, MIDI notes in piano roll will be
       extended whenever the sustain pedal is pressed.
+    :cvar bool SPLIT_ROLLS: If true, instead of a single stacked roll file,
+      onsets, frames and pedals are stored into 3 separate HDF5 files (with
+      suffixes ``_onsets``, ``_frames`` and ``_pedals``), so they can be read
+      independently. Note that the ``MelMaps`` dataloaders expect the
+      stacked file.
 
     :cvar int HDF5_CHUNKLEN_SECONDS: This parameter affects speed of the
       HDF5 read/write operations. Should be close to the chunk length used in
-      training (ideally a bit larger), but it isn't crucial to tune.
+      training (ideally a bit larger), but it isn't crucial to tune. It is
+      used as the minimal chunk length (see ``HDF5_CHUNK_BYTES``).
+    :cvar int HDF5_MAX_CHUNKLEN_FACTOR: Chunks are at most this many times
+      ``HDF5_CHUNKLEN_SECONDS`` long. Otherwise, small files (e.g. 3-row
+      pedal rolls) would get hours-long chunks, and every read would
+      decompress much more than needed.
+    :cvar int HDF5_CHUNK_BYTES: Target size of each HDF5 data chunk. The
+      chunk length of each file is chosen such that the chunk has roughly
+      this size, given the file height and dtype. Close to the HDF5 chunk
+      cache default size (1MB) is a good choice.
+    :cvar int HDF5_CACHE_BYTES: Size of the HDF5 chunk cache for writing.
+    :cvar str COMPRESSOR: HDF5 compression. ``blosc2_zstd`` (default)
+      requires the ``hdf5plugin`` package, also for reading. ``lzf`` is the
+      h5py built-in fallback.
+    :cvar int HDF5_BUFFER_CHUNKS: Results are buffered in RAM and written to
+      the HDF5 files in bulk, every this many chunks.
     :cvar str DEVICE: For the PyTorch operations. Can be ``cpu`` or ``cuda``
-      if a GPU is present, but CPU seems to be faster anyway.
+      if a GPU is present. On CPU, the logmels are computed by the workers.
+      Otherwise, workers only load and resample the audio, and the logmels
+      are computed in batches by the main process on the given device.
+    :cvar int LOGMEL_BATCH_SIZE: Number of waveforms per logmel batch, if
+      ``DEVICE`` is not ``cpu``.
     :cvar bool IGNORE_MEL: whether to compute only the piano rolls.
+    :cvar int NUM_WORKERS: Number of worker processes computing the features
+      in parallel. HDF5 writing is always done by the main process, in order.
+      Workers read their input files themselves. Their results are kept by
+      the main process until written, so RAM usage grows with the number of
+      jobs in flight (see ``MAX_PENDING_FILES``).
+    :cvar int PREFETCH_FILES: A background thread asks the OS to load this
+      many upcoming input files into the page cache, so workers don't wait
+      for the disk.
+    :cvar MAX_PENDING_FILES: Maximum number of files submitted to the workers
+      and not yet written, which bounds how many computed features are held
+      in RAM at once. If not given, ``NUM_WORKERS + PREFETCH_FILES``.
+    :cvar int GC_EVERY: Every this many files, garbage collection is forced
+      (and the CUDA cache emptied, if applicable), to keep memory stable.
     """
     INPATH: str = os.path.join("data", "PuDoMS1")
     OUTPUT_DIR: str = "data"
@@ -70,10 +120,263 @@ class ConfDef:
     MEL_FMAX: int = 8_000
     #
     MIDI_SUS_EXTEND: bool = True
+    SPLIT_ROLLS: bool = False
     #
     HDF5_CHUNKLEN_SECONDS: float = 8.0
+    HDF5_CHUNK_BYTES: int = 1_048_576
+    HDF5_MAX_CHUNKLEN_FACTOR: int = 16
+    HDF5_CACHE_BYTES: int = 64 * 1_048_576
+    COMPRESSOR: str = "blosc2_zstd"
+    HDF5_BUFFER_CHUNKS: int = 32
     DEVICE: str = "cpu"
+    LOGMEL_BATCH_SIZE: int = 8
     IGNORE_MEL: bool = False
+    NUM_WORKERS: int = os.cpu_count()
+    PREFETCH_FILES: int = 4
+    MAX_PENDING_FILES: Optional[int] = None
+    GC_EVERY: int = 50
+
+
+# Columns of the metadata sidecar files, one row per processed file
+METADATA_COLUMNS = ("basepath", "split", "duration", "composer", "title")
+
+
+# ##############################################################################
+# # WORKERS
+# ##############################################################################
+# Per-process state, populated by ``init_worker``. The functors are created
+# lazily inside each worker, so they never need to be pickled.
+_WORKER_CONF = None
+_LOGMEL_CACHE_PATH = None
+_LOGMEL_FN = None
+_PIANOROLL_FN = None
+
+
+def init_worker(conf, logmel_cache_path=None):
+    """
+    Initializer for the worker processes.
+
+    :param dict conf: Plain-dict version of the ``ConfDef`` configuration.
+    :param logmel_cache_path: See ``TorchWavToLogmel``.
+    """
+    global _WORKER_CONF, _LOGMEL_CACHE_PATH
+    _WORKER_CONF = conf
+    _LOGMEL_CACHE_PATH = logmel_cache_path
+    # parallelism comes from the processes, avoid thread oversubscription
+    torch.set_num_threads(1)
+
+
+def get_functors():
+    """
+    :returns: The per-process ``(logmel_fn, pianoroll_fn)`` pair, created on
+      first call. ``logmel_fn`` is ``None`` if ``IGNORE_MEL`` is active or
+      logmels are computed outside of the workers.
+    """
+    global _LOGMEL_FN, _PIANOROLL_FN
+    conf = _WORKER_CONF
+    if _PIANOROLL_FN is None:
+        if (not conf["IGNORE_MEL"]) and (conf["DEVICE"] == "cpu"):
+            # functor to create logmels from wavs
+            _LOGMEL_FN = TorchWavToLogmel(
+                conf["TARGET_SR"], conf["STFT_WINSIZE"],
+                conf["STFT_HOPSIZE"], conf["MELBINS"],
+                conf["MEL_FMIN"], conf["MEL_FMAX"],
+                cache_path=_LOGMEL_CACHE_PATH).to(conf["DEVICE"])
+        # functor to create piano rolls from MIDI
+        _PIANOROLL_FN = MidiToPianoRoll()
+    return _LOGMEL_FN, _PIANOROLL_FN
+
+
+def warm_page_cache(path, meta, wavpath, midipath):
+    """
+    Asks the OS to load the files needed by ``process_one`` into the page
+    cache, so that workers read them from RAM. The file contents are not
+    returned: each worker opens its own files.
+
+    :param wavpath: Path to the wav file. Ignored if ``None``.
+    :returns: The given ``(path, meta, wavpath, midipath)``.
+    """
+    for p in (wavpath, midipath):
+        if p is None:
+            continue
+        with open(p, "rb") as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            else:
+                while f.read(1_048_576):
+                    pass
+    return path, meta, wavpath, midipath
+
+
+def process_one(path, meta, wavpath, midipath):
+    """
+    Computes the features for a single file. Meant to be run inside of a
+    worker process initialized via ``init_worker``.
+
+    :param path: Path of the file, relative to ``INPATH`` and without extension
+    :param meta: Metadata tuple for this file, as given by ``PuDoMS.data``
+    :param wavpath: Path to the wav file (ignored if ``IGNORE_MEL``)
+    :param midipath: Path to the corresponding MIDI file
+    :returns: The tuple ``(metadata, logmel, rolls)``, where ``metadata`` is
+      a tuple following ``METADATA_COLUMNS`` and ``logmel`` is
+      ``None`` if ``IGNORE_MEL`` is active. If ``DEVICE`` is not ``cpu``,
+      the resampled 1D waveform is returned instead of the logmel.
+      ``rolls`` is a list with either the stacked roll, padded to the logmel
+      length, or the unpadded ``[onsets, frames, pedals]`` if
+      ``SPLIT_ROLLS`` is active.
+    """
+    conf = _WORKER_CONF
+    logmel_fn, pianoroll_fn = get_functors()
+    midi_quant_secs = conf["STFT_HOPSIZE"] / conf["TARGET_SR"]
+    #
+    basepath = os.path.basename(path)
+    metadata = (basepath, *meta)
+
+    logmel = None
+    if not conf["IGNORE_MEL"]:
+        with torch.no_grad():
+            wave = torch_load_resample_audio(
+                wavpath, conf["TARGET_SR"],
+                mono=True, normalize_wav=True, device="cpu")
+            if logmel_fn is not None:
+                # compute logmel
+                logmel = logmel_fn(wave).numpy()
+                len_logmel = logmel.shape[1]
+                del wave
+            else:
+                # logmel computed by the main process in batches
+                logmel = wave.numpy()
+                len_logmel = 1 + len(logmel) // conf["STFT_HOPSIZE"]
+
+    # compute piano roll
+    (onset_roll, offset_roll, frame_roll,
+     sus_roll, soft_roll, ten_roll, key_events) = pianoroll_fn(
+         midipath, GeneralMidiParser,
+         quant_secs=midi_quant_secs,
+         extend_offsets_sus=conf["MIDI_SUS_EXTEND"],
+         ignore_redundant_keypress=True,
+         ignore_redundant_keylift=True)
+    del offset_roll, key_events  # not needed
+    _, len_roll = onset_roll.shape
+    if not conf["IGNORE_MEL"]:
+        assert len_logmel >= len_roll, \
+            "Wav isn't expected to be shorter than MIDI!"
+    if conf["SPLIT_ROLLS"]:
+        # stored separately, the HDF5 writers take care of the padding
+        pedals = np.stack([sus_roll, soft_roll, ten_roll])
+        return metadata, logmel, [onset_roll, frame_roll, pedals]
+    # write [onsets; frames; pedals] into a single preallocated roll. If the
+    # wav is longer than the MIDI, the roll end stays zero-padded. All values
+    # are MIDI velocities/pedal values in [0, 127], so uint8 is lossless
+    n = MidiToPianoRoll.NUM_MIDI_VALUES
+    out_len = len_roll if conf["IGNORE_MEL"] else len_logmel
+    roll = np.zeros((2 * n + 3, out_len), dtype=np.uint8)
+    roll[:n, :len_roll] = onset_roll
+    roll[n:(2 * n), :len_roll] = frame_roll
+    roll[2 * n, :len_roll] = sus_roll
+    roll[2 * n + 1, :len_roll] = soft_roll
+    roll[2 * n + 2, :len_roll] = ten_roll
+    # plt.clf(); plt.imshow(logmel[::-1]); plt.show()
+    # plt.clf(); plt.imshow(onset_roll[::-1]); plt.show()
+    #
+    return metadata, logmel, [roll]
+
+
+def bounded_map(executor, fn, jobs, max_pending):
+    """
+    Like ``executor.map(fn, *zip(*jobs))``, but keeping at most
+    ``max_pending`` submitted jobs at any time, so that finished results
+    don't pile up in memory if the consumer is slower than the workers.
+
+    :param jobs: Iterable of argument tuples for ``fn``.
+    :returns: Generator of results, in the same order as ``jobs``.
+    """
+    pending = deque()
+    for args in jobs:
+        pending.append(executor.submit(fn, *args))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def copy_to_host(tensors, host_buffer, stream):
+    """
+    Copies the given CUDA tensors into consecutive regions of a reusable,
+    pinned ``host_buffer``. The copies are issued asynchronously on the given
+    CUDA ``stream`` (after all pending work on the current stream of the
+    device holding the tensors), and this function waits only once, when all
+    of them are done.
+
+    :param tensors: Collection of CUDA tensors with same dtype.
+    :param host_buffer: Flat, pinned CPU tensor. If ``None`` or too small, it
+      is replaced by a larger one.
+    :returns: The pair ``(arrays, host_buffer)``, where ``arrays`` contains
+      numpy views of the copied tensors. Note that they are views into
+      ``host_buffer``, so they will be overwritten by the next call.
+    """
+    total_numel = sum(t.numel() for t in tensors)
+    if (host_buffer is None) or (host_buffer.numel() < total_numel):
+        host_buffer = torch.empty(total_numel, dtype=tensors[0].dtype,
+                                  pin_memory=True)
+    # the tensors may not be on the current (default) device, e.g. cuda:1
+    stream.wait_stream(torch.cuda.current_stream(tensors[0].device))
+    views = []
+    beg = 0
+    with torch.cuda.stream(stream):
+        for t in tensors:
+            end = beg + t.numel()
+            view = host_buffer[beg:end].view(t.shape)
+            view.copy_(t, non_blocking=True)
+            views.append(view)
+            beg = end
+    stream.synchronize()
+    arrays = [v.numpy() for v in views]
+    return arrays, host_buffer
+
+
+def prefetch(iterable, fn, maxsize):
+    """
+    Runs ``fn`` on each element of ``iterable`` in a background thread, and
+    yields the results in order, keeping at most ``maxsize`` of them ready.
+    Useful to overlap I/O-bound work (e.g. reading files) with computation.
+    Exceptions raised by ``fn`` are re-raised by the generator.
+    """
+    q = queue.Queue(maxsize=maxsize)
+    end = object()
+
+    def producer():
+        try:
+            for x in iterable:
+                q.put((fn(x), None))
+        except Exception as e:
+            q.put((None, e))
+            return
+        q.put((end, None))
+    threading.Thread(target=producer, daemon=True).start()
+    #
+    while True:
+        result, error = q.get()
+        if error is not None:
+            raise error
+        if result is end:
+            return
+        yield result
+
+
+def batched(iterable, n):
+    """
+    :returns: Generator of lists with ``n`` consecutive elements from
+      ``iterable`` (the last one may be shorter).
+    """
+    batch = []
+    for x in iterable:
+        batch.append(x)
+        if len(batch) >= n:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
 
 
 # ##############################################################################
@@ -91,7 +394,23 @@ if __name__ == "__main__":
     HDF5_CHUNKLEN = round(CONF.HDF5_CHUNKLEN_SECONDS /
                           (CONF.STFT_HOPSIZE / CONF.TARGET_SR))
     ROLL_HEIGHT = 3 + MidiToPianoRoll.NUM_MIDI_VALUES * 2
+    # (suffix, height) of each roll file
+    ROLL_PARTS = ([("_onsets", MidiToPianoRoll.NUM_MIDI_VALUES),
+                   ("_frames", MidiToPianoRoll.NUM_MIDI_VALUES),
+                   ("_pedals", 3)] if CONF.SPLIT_ROLLS
+                  else [("", ROLL_HEIGHT)])
     MIDI_QUANT_SECS = CONF.STFT_HOPSIZE / CONF.TARGET_SR
+    HDF5_COMPRESSION = get_hdf5_compression(CONF.COMPRESSOR)
+    # chunk lengths such that each chunk has roughly HDF5_CHUNK_BYTES, within
+    # [1, HDF5_MAX_CHUNKLEN_FACTOR] times HDF5_CHUNKLEN
+    MEL_DTYPE, ROLL_DTYPE = np.float32, np.uint8
+    MAX_CHUNKLEN = CONF.HDF5_MAX_CHUNKLEN_FACTOR * HDF5_CHUNKLEN
+    MEL_CHUNKLEN = min(MAX_CHUNKLEN, max(
+        HDF5_CHUNKLEN, CONF.HDF5_CHUNK_BYTES // (
+            CONF.MELBINS * np.dtype(MEL_DTYPE).itemsize)))
+    ROLL_CHUNKLENS = [min(MAX_CHUNKLEN, max(
+        HDF5_CHUNKLEN, CONF.HDF5_CHUNK_BYTES // (
+            h * np.dtype(ROLL_DTYPE).itemsize))) for _, h in ROLL_PARTS]
 
     # output path
     os.makedirs(CONF.OUTPUT_DIR, exist_ok=True)
@@ -102,98 +421,183 @@ if __name__ == "__main__":
                 f"PuDoMS1", CONF.TARGET_SR,
                 CONF.STFT_WINSIZE, CONF.STFT_HOPSIZE, CONF.MELBINS,
                 CONF.MEL_FMIN, CONF.MEL_FMAX))
+        # STFT window and mel filterbank, reused across runs and workers
+        LOGMEL_CACHE_PATH = os.path.splitext(HDF5_MEL_OUTPATH)[0] + "_fb.pt"
+    else:
+        LOGMEL_CACHE_PATH = None
     HDF5_ROLL_OUTPATH = os.path.join(
         CONF.OUTPUT_DIR,
         HDF5PathManager.get_roll_hdf5_basename(
             f"PuDoMS1", MIDI_QUANT_SECS,
             MidiToPianoRoll.NUM_MIDI_VALUES, CONF.MIDI_SUS_EXTEND))
+    HDF5_ROLL_OUTPATHS = [
+        os.path.splitext(HDF5_ROLL_OUTPATH)[0] + suffix + ".h5"
+        for suffix, _ in ROLL_PARTS]
+    HDF5_OUTPATHS = ([] if CONF.IGNORE_MEL else [HDF5_MEL_OUTPATH]) + \
+        HDF5_ROLL_OUTPATHS
+    # like the HDF5 files, stale metadata sidecars must not be reused
+    for outpath in HDF5_OUTPATHS:
+        sidecar_path = HDF5PathManager.get_metadata_sidecar_path(outpath)
+        if os.path.isfile(sidecar_path):
+            raise FileExistsError(f"File already exists! {sidecar_path}")
 
     all = METACLASS(CONF.INPATH, splits=PuDoMS.ALL_SPLITS)
 
+    # if not on CPU, logmels are computed here in batches (see process_one)
+    BATCHED_LOGMEL = (not CONF.IGNORE_MEL) and (CONF.DEVICE != "cpu")
     if not CONF.IGNORE_MEL:
-        # functor to create logmels from wavs
+        # this also creates the constants cache before the workers start
         logmel_fn = TorchWavToLogmel(
             CONF.TARGET_SR, CONF.STFT_WINSIZE,
             CONF.STFT_HOPSIZE, CONF.MELBINS,
-            CONF.MEL_FMIN, CONF.MEL_FMAX).to(CONF.DEVICE)
-    # functor to create piano rolls from MIDI
-    pianoroll_fn = MidiToPianoRoll()
+            CONF.MEL_FMIN, CONF.MEL_FMAX,
+            cache_path=LOGMEL_CACHE_PATH).to(CONF.DEVICE)
+    # on CUDA, logmels are copied to a reusable pinned buffer on a side stream
+    PINNED_COPY = BATCHED_LOGMEL and CONF.DEVICE.startswith("cuda")
+    if PINNED_COPY:
+        host_buffer = None
+        copy_stream = torch.cuda.Stream(device=CONF.DEVICE)
 
     # corresponding HDF5 file handles
     if not CONF.IGNORE_MEL:
-        h5mel = IncrementalHDF5(
-            HDF5_MEL_OUTPATH, CONF.MELBINS, dtype=np.float32,
-            compression="lzf", data_chunk_length=HDF5_CHUNKLEN,
-            metadata_chunk_length=HDF5_CHUNKLEN, err_if_exists=True)
-    h5roll = IncrementalHDF5(
-        HDF5_ROLL_OUTPATH, ROLL_HEIGHT, dtype=np.float32,
-        compression="lzf", data_chunk_length=HDF5_CHUNKLEN,
-        metadata_chunk_length=HDF5_CHUNKLEN, err_if_exists=True)
+        h5mel = BufferedIncrementalHDF5(
+            HDF5_MEL_OUTPATH, CONF.MELBINS, dtype=MEL_DTYPE,
+            compression=HDF5_COMPRESSION, data_chunk_length=MEL_CHUNKLEN,
+            metadata_chunk_length=HDF5_CHUNKLEN, err_if_exists=True,
+            cache_bytes=CONF.HDF5_CACHE_BYTES,
+            buffer_length=MEL_CHUNKLEN * CONF.HDF5_BUFFER_CHUNKS)
+    h5rolls = [BufferedIncrementalHDF5(
+        outpath, h, dtype=ROLL_DTYPE,
+        compression=HDF5_COMPRESSION, data_chunk_length=chunklen,
+        metadata_chunk_length=HDF5_CHUNKLEN, err_if_exists=True,
+        cache_bytes=CONF.HDF5_CACHE_BYTES,
+        buffer_length=chunklen * CONF.HDF5_BUFFER_CHUNKS)
+               for outpath, (_, h), chunklen in zip(
+                       HDF5_ROLL_OUTPATHS, ROLL_PARTS, ROLL_CHUNKLENS)]
 
     print("Computing features...")
     if not CONF.IGNORE_MEL:
         print("Logmels stored into", HDF5_MEL_OUTPATH)
-    print("Piano rolls stored into", HDF5_ROLL_OUTPATH)
-    loop_length = len(all.data)
+    print("Piano rolls stored into", *HDF5_ROLL_OUTPATHS)
 
-    for i, (path, meta) in enumerate(all.data, 1):
+    # gather the (path, meta, wavpath, midipath) jobs, skipping files with
+    # missing wav or MIDI. Scanning INPATH once yields a {stem: {ext: path}}
+    # map, so no further stat syscalls are needed
+    entries = {}
+    with os.scandir(CONF.INPATH) as it:
+        for e in it:
+            stem, _, ext = e.name.rpartition(".")
+            entries.setdefault(stem, {})[ext] = e.path
+    jobs = []
+    for path, meta in all.data:
         basepath = os.path.basename(path)
-        # Construct the MIDI file path with .mid extension
-        midipath_mid = os.path.join(CONF.INPATH, f"{basepath}.mid")
-        # Construct the MIDI file path with .midi extension
-        midipath_midi = os.path.join(CONF.INPATH, f"{basepath}.midi")
-
-        # Determine which file path exists
-        if os.path.exists(midipath_mid):
-            midipath = midipath_mid
-        elif os.path.exists(midipath_midi):
-            midipath = midipath_midi
-        else:
+        exts = entries.get(basepath, {})
+        # Determine which MIDI extension exists, .mid or .midi
+        midipath = exts.get("mid") or exts.get("midi")
+        if midipath is None:
             print(f"MIDI file for {basepath} not found in either .mid or .midi format.")
             continue
-        print(f"Processing MIDI file: {midipath}")
-        abspath = os.path.join(CONF.INPATH, path)
-        metadata = str((basepath, *meta))
-
-        if not CONF.IGNORE_MEL:
-            # compute logmel and add to corresponding HDF5
-            with torch.no_grad():
-                wave = torch_load_resample_audio(
-                    abspath + METACLASS.AUDIO_EXT, CONF.TARGET_SR,
-                    mono=True, normalize_wav=True, device=CONF.DEVICE)
-                logmel = logmel_fn(wave).to("cpu").numpy()
-            h5mel.append(logmel, metadata)
-
-        # compute piano roll and add to corresponding HDF5
-        (onset_roll, offset_roll, frame_roll,
-         sus_roll, soft_roll, ten_roll, key_events) = pianoroll_fn(
-             midipath, GeneralMidiParser, quant_secs=MIDI_QUANT_SECS,
-             extend_offsets_sus=CONF.MIDI_SUS_EXTEND,
-             ignore_redundant_keypress=True,
-             ignore_redundant_keylift=True)
-        roll = np.vstack([onset_roll, frame_roll,
-                          sus_roll, soft_roll, ten_roll])
-        #
-        _, len_roll = roll.shape
+        wavpath = None
         if not CONF.IGNORE_MEL:
-            _, len_logmel = logmel.shape
-            assert len_logmel >= len_roll, \
-                "Wav isn't expected to be shorter than MIDI!"
-            if len_logmel > len_roll:
-                # print("WARNING: wav is longer than MIDI.",
-                #       "Padding MIDI end with zeros")
-                roll = np.pad(roll, ((0, 0), (0, len_logmel - len_roll)))
-            assert len_logmel == roll.shape[1], \
-                "Logmel and roll have different length?"
-        # plt.clf(); plt.imshow(logmel[::-1]); plt.show()
-        # plt.clf(); plt.imshow(onset_roll[::-1]); plt.show()
-        #
-        h5roll.append(roll, metadata)
-        #
-        if (i % 5) == 0:
-            print(f"[{i}/{loop_length}]", abspath)
+            wavpath = exts.get(PuDoMS.AUDIO_EXT.lstrip("."))
+            if wavpath is None:
+                print(f"Audio file for {basepath} not found, skipping.")
+                continue
+        jobs.append((path, meta, wavpath, midipath))
+    loop_length = len(jobs)
+
+    # pre-size the HDF5 datasets from the wav headers, so appends don't need
+    # to resize them. Rolls are padded to the logmel length, so they have the
+    # same total width. Without logmels, only the entries are reserved
+    total_frames = 0
+    if not CONF.IGNORE_MEL:
+        total_frames = sum(
+            1 + get_resampled_length(wavpath, CONF.TARGET_SR) //
+            CONF.STFT_HOPSIZE for _, _, wavpath, _ in jobs)
+        h5mel.reserve(total_frames, loop_length)
+    for h5roll in h5rolls:
+        h5roll.reserve(total_frames, loop_length)
+
+    # workers compute features, main process appends them to HDF5 in order.
+    # Pending results are held in RAM, so their number is capped
+    MAX_PENDING_FILES = CONF.MAX_PENDING_FILES
+    if MAX_PENDING_FILES is None:
+        MAX_PENDING_FILES = CONF.NUM_WORKERS + CONF.PREFETCH_FILES
+    # workers must not be forked from this process, since it runs the
+    # prefetch thread (and may have initialized CUDA)
+    MP_CONTEXT = multiprocessing.get_context(
+        "forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+        else "spawn")
+    with ProcessPoolExecutor(max_workers=CONF.NUM_WORKERS,
+                             mp_context=MP_CONTEXT,
+                             initializer=init_worker,
+                             initargs=(OmegaConf.to_container(CONF),
+                                       LOGMEL_CACHE_PATH)) as ex:
+        # a background thread warms up the page cache in advance
+        warm_jobs = prefetch(jobs, lambda job: warm_page_cache(*job),
+                             CONF.PREFETCH_FILES)
+        results = bounded_map(ex, process_one, warm_jobs,
+                              max_pending=MAX_PENDING_FILES)
+        i = 0
+        next_gc = CONF.GC_EVERY
+        metadata_rows = []
+        for batch in batched(zip(jobs, results),
+                             CONF.LOGMEL_BATCH_SIZE if BATCHED_LOGMEL else 1):
+            if BATCHED_LOGMEL:
+                # workers returned waves: compute logmels in a single batch
+                with torch.no_grad():
+                    waves = [torch.from_numpy(w).to(CONF.DEVICE)
+                             for _, (_, w, _) in batch]
+                    logmels = logmel_fn.forward_batch(waves)
+                    if i == 0:
+                        # batching shouldn't alter the logmels. Only warn,
+                        # since small numerical differences are possible
+                        max_diff = max((lm - logmel_fn(w)).abs().max().item()
+                                       for lm, w in zip(logmels, waves))
+                        if max_diff > 1e-3:
+                            print("WARNING: Batched logmels differ from",
+                                  f"per-file ones by up to {max_diff} dB")
+                    del waves
+                    if PINNED_COPY:
+                        # h5mel copies the arrays, so the buffer can be reused
+                        logmels, host_buffer = copy_to_host(
+                            logmels, host_buffer, copy_stream)
+                    else:
+                        logmels = [lm.to("cpu").numpy() for lm in logmels]
+            else:
+                logmels = [lm for _, (_, lm, _) in batch]
+            #
+            for ((path, _, _, _), (metadata, _, rolls)), logmel in zip(
+                    batch, logmels):
+                i += 1
+                # metadata goes to the sidecar, not into the HDF5 files
+                metadata_rows.append(metadata)
+                if not CONF.IGNORE_MEL:
+                    h5mel.append(logmel, "")
+                # rolls are padded to the logmel length
+                pad_to = None if CONF.IGNORE_MEL else logmel.shape[1]
+                for h5roll, roll in zip(h5rolls, rolls):
+                    h5roll.append(roll, "", pad_to=pad_to)
+                #
+                if (i % 5) == 0:
+                    print(f"[{i}/{loop_length}]",
+                          os.path.join(CONF.INPATH, path))
+            # release this batch before the next one arrives
+            del batch, logmels, logmel, rolls
+            if i >= next_gc:
+                gc.collect()
+                if CONF.DEVICE.startswith("cuda"):
+                    torch.cuda.empty_cache()
+                next_gc += CONF.GC_EVERY
 
     if not CONF.IGNORE_MEL:
         h5mel.close()
-    h5roll.close()
+    for h5roll in h5rolls:
+        h5roll.close()
+    # write metadata sidecars, with one row per HDF5 entry. This happens only
+    # after a successful run, since the HDF5 metadata strings are left empty
+    metadata_df = pd.DataFrame(metadata_rows, columns=METADATA_COLUMNS)
+    for outpath in HDF5_OUTPATHS:
+        metadata_df.to_parquet(
+            HDF5PathManager.get_metadata_sidecar_path(outpath))
     print("Done!")